@@ -2,16 +2,18 @@
 
 from __future__ import annotations
 
-import json
 import os
 import uuid
 from contextlib import contextmanager
 from datetime import datetime
-from typing import Any, Dict, Generator, Optional
+from typing import Any, Dict, Generator, Iterable, Optional, Set
 
-from sqlalchemy import Column, DateTime, String, Text, create_engine
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session, declarative_base, sessionmaker
+import orjson
+from sqlalchemy import Column, DateTime, Index, LargeBinary, String, create_engine, event, inspect, select, text
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, declarative_base, defer, sessionmaker
 
 os.makedirs("tmp", exist_ok=True)
 
@@ -19,18 +21,80 @@ DATABASE_URL = os.getenv("DB_PATH") or os.getenv(
     "DATABASE_URL", "sqlite:///tmp/emailer.db"
 )
 
+# Shared with API responses so anything a job row can hold also serializes on the wire.
+JSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY
+# Stays under SQLite's bound-parameter limit for large lead lists.
+_IN_CHUNK_SIZE = 500
+
+
+def _engine_options(url: URL) -> Dict[str, Any]:
+    if url.get_backend_name() != "sqlite":
+        return {
+            "pool_size": 20,
+            "max_overflow": 40,
+            "pool_recycle": 3600,
+            "pool_pre_ping": True,
+            # Reuse the most recently returned connection so idle ones reach pool_recycle.
+            "pool_use_lifo": True,
+        }
+    options: Dict[str, Any] = {"connect_args": {"check_same_thread": False}}
+    if _is_file_database(url):
+        # In-memory SQLite uses a singleton/static pool that takes no sizing arguments.
+        options.update(pool_size=20, max_overflow=40)
+    return options
+
+
+def _is_file_database(url: URL) -> bool:
+    return url.database not in (None, "", ":memory:")
+
+
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+_url = make_url(DATABASE_URL)
+engine = create_engine(_url, **_engine_options(_url))
+
+_SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=10737418240",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=30000",
+)
+
+if engine.dialect.name == "sqlite":
+
+    @event.listens_for(engine, "connect")
+    def _configure_sqlite(dbapi_conn: Any, _record: Any) -> None:
+        cursor = dbapi_conn.cursor()
+        try:
+            # WAL needs a real file; in-memory databases keep the default journal.
+            if _is_file_database(engine.url):
+                cursor.execute("PRAGMA journal_mode=WAL")
+            for pragma in _SQLITE_PRAGMAS:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+# Both dialects support INSERT ... ON CONFLICT DO NOTHING.
+_upsert_insert = postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert
+
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 
 
+def _dumps(data: Dict[str, Any]) -> bytes:
+    return orjson.dumps(data, option=JSON_OPTIONS)
+
+
 class Job(Base):
     __tablename__ = "jobs"
+    # Serves status-only lookups too via its leading column.
+    __table_args__ = (Index("ix_jobs_status_created_at", "status", "created_at"),)
 
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     status = Column(String, nullable=False, default="pending")
-    payload = Column(Text, nullable=True)
-    result = Column(Text, nullable=True)
+    # orjson bytes; rows written as TEXT by older builds still load via orjson.loads.
+    payload = Column(LargeBinary, nullable=True)
+    result = Column(LargeBinary, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
@@ -38,20 +102,27 @@ class Job(Base):
         self.updated_at = datetime.utcnow()
 
     def set_payload(self, data: Dict[str, Any]) -> None:
-        self.payload = json.dumps(data)
+        self.payload = _dumps(data)
 
     def get_payload(self) -> Optional[Dict[str, Any]]:
         if not self.payload:
             return None
-        return json.loads(self.payload)
+        return orjson.loads(self.payload)
+
+    def get_payload_fragment(self) -> Optional[orjson.Fragment]:
+        """Stored payload JSON, embeddable in an orjson document without re-parsing."""
+        return orjson.Fragment(self.payload) if self.payload else None
 
     def set_result(self, data: Dict[str, Any]) -> None:
-        self.result = json.dumps(data)
+        self.result = _dumps(data)
 
     def get_result(self) -> Optional[Dict[str, Any]]:
         if not self.result:
             return None
-        return json.loads(self.result)
+        return orjson.loads(self.result)
+
+    def get_result_fragment(self) -> Optional[orjson.Fragment]:
+        return orjson.Fragment(self.result) if self.result else None
 
 
 class Suppression(Base):
@@ -63,6 +134,27 @@ class Suppression(Base):
 
 def init_db() -> None:
     Base.metadata.create_all(bind=engine)
+    # create_all skips tables that already exist; backfill indexes added later.
+    for index in Job.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    _migrate_job_json_columns()
+
+
+def _migrate_job_json_columns() -> None:
+    """Convert TEXT payload/result columns from older builds to binary, once.
+
+    SQLite's dynamic typing stores bytes in the old TEXT columns as-is, but Postgres
+    rejects binding bytes to TEXT, so existing tables there are altered in place.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    columns = {column["name"]: column["type"] for column in inspect(engine).get_columns(Job.__tablename__)}
+    with engine.begin() as conn:
+        for name in ("payload", "result"):
+            if name in columns and not isinstance(columns[name], LargeBinary):
+                conn.execute(
+                    text(f"ALTER TABLE jobs ALTER COLUMN {name} TYPE bytea USING convert_to({name}, 'UTF8')")
+                )
 
 
 @contextmanager
@@ -96,25 +188,33 @@ def update_job_status(
     job.update_timestamp()
     if result is not None:
         job.set_result(result)
-    session.add(job)
-    session.flush()
     return job
 
 
-def get_job(session: Session, job_id: str) -> Optional[Job]:
-    return session.get(Job, job_id)
+def get_job(session: Session, job_id: str, *, with_payload: bool = True) -> Optional[Job]:
+    options = [] if with_payload else [defer(Job.payload)]
+    return session.get(Job, job_id, options=options)
 
 
 def add_to_suppression(session: Session, email: str) -> bool:
-    record = Suppression(email=email.lower())
-    session.add(record)
-    try:
-        session.flush()
-        return True
-    except IntegrityError:
-        session.rollback()
-        return False
+    stmt = (
+        _upsert_insert(Suppression)
+        .values(email=email.lower())
+        .on_conflict_do_nothing(index_elements=[Suppression.email])
+    )
+    return session.execute(stmt).rowcount > 0
 
 
 def is_suppressed(session: Session, email: str) -> bool:
     return session.get(Suppression, email.lower()) is not None
+
+
+def load_suppressions(session: Session, emails: Iterable[str]) -> Set[str]:
+    # Stored addresses are already lowercase, so compare the raw column and keep its index usable.
+    lowered = list(dict.fromkeys(email.lower() for email in emails))
+    suppressed: Set[str] = set()
+    for start in range(0, len(lowered), _IN_CHUNK_SIZE):
+        chunk = lowered[start : start + _IN_CHUNK_SIZE]
+        rows = session.execute(select(Suppression.email).where(Suppression.email.in_(chunk)))
+        suppressed.update(rows.scalars())
+    return suppressed
@@ -1,37 +1,102 @@
 """FastAPI application entrypoint for rh-emailer."""
 
+import asyncio
 import json
 import logging
 import os
+import random
 import re
+import time
 import uuid
-from typing import Any, Dict, List, Optional, Literal, Union
-
-from fastapi import Body, Depends, FastAPI, File, Form, HTTPException, Query, UploadFile
+from collections import ChainMap, Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Literal, Tuple, TypeVar, Union
+
+import anyio
+import orjson
+from fastapi import BackgroundTasks, Body, Depends, FastAPI, File, Form, HTTPException, Query, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.routing import APIRoute
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from pydantic import BaseModel, EmailStr, Field, field_validator
-from ratelimit import limits, sleep_and_retry
+from sqlalchemy.orm import Session
 
 from . import db
-from .parsers import ParsedDocument, handle_uploads, redact_payload
+from .parsers import (
+    ParsedDocument,
+    handle_saved_uploads,
+    handle_uploads,
+    redact_lead,
+    remove_saved_uploads,
+    save_uploads,
+)
 from .utils import (
     BUSINESS_ADDRESS,
+    DOMAIN_MPS_LIMIT,
     OPTOUT_LINK,
     EmailPayload,
+    SendResult,
+    MAX_BULK_RECIPIENTS,
     MPS_LIMIT,
+    TokenBucket,
     WINDOW_SECONDS,
+    close_sendgrid_http,
+    email_domain,
+    get_template_env,
+    interleave_by_domain,
     render_email,
+    send_email_bulk,
     send_email_with_fallback,
 )
 
+T = TypeVar("T")
+R = TypeVar("R")
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 
 API_BEARER_TOKEN = os.getenv("API_BEARER_TOKEN")
 DEFAULT_TONE = "conservative"
+# Sync endpoints (DB sessions, SendGrid calls) run on AnyIO's worker threads.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
+SEND_MAX_ATTEMPTS = 3
+PREPARE_TIMEOUT_SECONDS = int(os.getenv("PREPARE_TIMEOUT_SECONDS", "900"))
+_RECIPIENT_SEPARATORS = re.compile(r"[;,]")
+
+
+class ORJSONRequest(Request):
+    """Request whose JSON body is decoded with orjson instead of the stdlib."""
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+
+class ORJSONRoute(APIRoute):
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            return await handler(ORJSONRequest(request.scope, request.receive))
+
+        return route_handler
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    get_template_env()
+    yield
+    close_sendgrid_http()
 
-app = FastAPI(title="rh-emailer", version="1.1.2")
+
+app = FastAPI(title="rh-emailer", version="1.1.2", lifespan=lifespan)
+app.router.route_class = ORJSONRoute
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -46,6 +111,7 @@ security = HTTPBearer(auto_error=False)
 
 class PrepareResponse(BaseModel):
     prepare_id: str
+    status: Literal["prepared", "processing"] = "prepared"
     count: int
     preview: List[Dict[str, Any]]
     metrics: Dict[str, Any]
@@ -78,7 +144,7 @@ class DirectSendRequest(BaseModel):
                 raise ValueError("At least one recipient email is required.")
             return value
         if isinstance(value, str):
-            candidates = [part.strip() for part in re.split(r"[;,]", value) if part.strip()]
+            candidates = [part for part in map(str.strip, _RECIPIENT_SEPARATORS.split(value)) if part]
             if len(candidates) > 1:
                 return candidates
             return value
@@ -91,6 +157,8 @@ class DirectSendRecipientResult(BaseModel):
     email: EmailStr
     sent: bool
     reason: Optional[str] = None
+    # Set for temporary SendGrid failures (network errors, 429, 5xx) worth resending.
+    retryable: bool = False
 
 
 class DirectSendResponse(BaseModel):
@@ -100,10 +168,6 @@ class DirectSendResponse(BaseModel):
     results: Optional[List[DirectSendRecipientResult]] = None
 
 
-DirectSendRequest.model_rebuild()
-DirectSendRecipientResult.model_rebuild()
-DirectSendResponse.model_rebuild()
-
 class StatusResponse(BaseModel):
     job_id: str
     status: str
@@ -120,6 +184,10 @@ class UnsubscribeRequest(BaseModel):
     email: EmailStr
 
 
+def _json_response(content: Any) -> Response:
+    return Response(orjson.dumps(content, option=db.JSON_OPTIONS), media_type="application/json")
+
+
 def auth(credentials: HTTPAuthorizationCredentials = Depends(security)) -> None:
     if not API_BEARER_TOKEN:
         return
@@ -132,18 +200,42 @@ def health() -> Dict[str, str]:
     return {"status": "ok", "version": app.version if hasattr(app, "version") else "unknown"}
 
 
-@app.post("/prepare", response_model=PrepareResponse)
+# The preview carries up to ten rendered HTML bodies; serialize it straight to
+# JSON rather than having FastAPI walk it again through PrepareResponse.
+@app.post(
+    "/prepare",
+    response_model=None,
+    responses={200: {"model": PrepareResponse}},
+)
 def prepare_endpoint(
+    background_tasks: BackgroundTasks,
     files: List[UploadFile] = File(...),
     tone: str = Form(DEFAULT_TONE),
+    background: bool = Form(False),
     _: None = Depends(auth),
-) -> PrepareResponse:
+) -> Response:
     if not files:
         raise HTTPException(status_code=400, detail="No files uploaded")
 
     tone = tone.lower()
     template_name = _resolve_template(tone)
 
+    if background:
+        # Uploads are closed once the response goes out, so keep copies for the task.
+        paths = save_uploads(files)
+        with db.get_session() as session:
+            job = db.create_job(session, {"tone": tone})
+            db.update_job_status(session, job.id, "processing")
+            prepare_id = job.id
+        background_tasks.add_task(_run_prepare_job, prepare_id, paths, tone, template_name)
+        return _json_response({
+            "prepare_id": prepare_id,
+            "status": "processing",
+            "count": 0,
+            "preview": [],
+            "metrics": {},
+        })
+
     parsed: ParsedDocument = handle_uploads(files)
     payload = {
         "tone": tone,
@@ -158,11 +250,55 @@ def prepare_endpoint(
         db.update_job_status(session, job.id, "prepared")
         prepare_id = job.id
 
-    return PrepareResponse(
-        prepare_id=prepare_id,
-        count=len(parsed.leads),
-        preview=preview_entries,
-        metrics=parsed.metrics,
+    return _json_response({
+        "prepare_id": prepare_id,
+        "status": "prepared",
+        "count": len(parsed.leads),
+        "preview": preview_entries,
+        "metrics": parsed.metrics,
+    })
+
+
+def _run_prepare_job(job_id: str, paths: List[Path], tone: str, template_name: str) -> None:
+    try:
+        parsed = handle_saved_uploads(paths)
+        preview_entries = _build_preview(parsed.leads, parsed.metrics, template_name)
+    except Exception as exc:
+        logger.exception("Prepare job %s failed", job_id)
+        with db.get_session() as session:
+            db.update_job_status(session, job_id, "failed", result={"error": str(exc)})
+        return
+    finally:
+        remove_saved_uploads(paths)
+
+    # The preview goes in the job result so /status can return what /prepare would have.
+    with db.get_session() as session:
+        job = db.get_job(session, job_id)
+        if job is None:
+            return
+        job.set_payload({"tone": tone, "metrics": parsed.metrics, "leads": parsed.leads})
+        db.update_job_status(
+            session,
+            job_id,
+            "prepared",
+            result={
+                "count": len(parsed.leads),
+                "preview": preview_entries,
+                "metrics": parsed.metrics,
+            },
+        )
+
+
+def _expire_stale_prepare(session: Session, job: db.Job) -> None:
+    # Background prepare tasks die with the process, so a job still processing long
+    # after its last update will never finish; fail it rather than leave it stuck.
+    if job.status != "processing":
+        return
+    if datetime.utcnow() - job.updated_at < timedelta(seconds=PREPARE_TIMEOUT_SECONDS):
+        return
+    logger.warning("Prepare job %s timed out while processing", job.id)
+    db.update_job_status(
+        session, job.id, "failed", result={"error": "Prepare did not finish; upload the files again."}
     )
 
 
@@ -170,22 +306,32 @@ def _build_preview(
     leads: List[Dict[str, Any]], metrics: Dict[str, Any], template_name: str
 ) -> List[Dict[str, Any]]:
     preview: List[Dict[str, Any]] = []
+    # Metrics are shared, so identical lead rows render identical HTML. The memo lives
+    # only for this call so rendered PII isn't retained between requests.
+    rendered: Dict[Tuple[Tuple[str, Any], ...], str] = {}
     for lead in leads[:10]:
-        context = {**metrics, **lead}
-        html = render_email(template_name, context)
+        key = tuple(sorted(lead.items()))
+        html = rendered.get(key)
+        if html is None:
+            html = rendered[key] = render_email(template_name, ChainMap(lead, metrics))
         preview.append({
-            "lead": redact_payload({"leads": [lead]}).get("leads", [lead])[0],
+            "lead": redact_lead(lead),
             "email_html": html,
         })
     return preview
 
 
 @app.post("/send", response_model=SendResponse)
-def send_endpoint(request: SendRequest, _: None = Depends(auth)) -> SendResponse:
+def send_endpoint(
+    request: SendRequest, background_tasks: BackgroundTasks, _: None = Depends(auth)
+) -> SendResponse:
     with db.get_session() as session:
         prepare_job = db.get_job(session, request.prepare_id)
         if prepare_job is None:
             raise HTTPException(status_code=404, detail="prepare_id not found")
+        _expire_stale_prepare(session, prepare_job)
+        if prepare_job.status == "processing":
+            raise HTTPException(status_code=409, detail="prepare_id is still processing")
         payload = prepare_job.get_payload() or {}
         leads = payload.get("leads", [])
         if not leads:
@@ -199,54 +345,100 @@ def send_endpoint(request: SendRequest, _: None = Depends(auth)) -> SendResponse
             "dry_run": request.dry_run,
         }
         send_job = db.create_job(session, send_job_payload)
-        db.update_job_status(session, send_job.id, "queued")
         job_id = send_job.id
 
-    if request.dry_run:
-        summary = {
-            "message": "Dry run completed; no emails sent",
-            "recipients": len(leads),
-        }
-        with db.get_session() as session:
+        if request.dry_run:
+            summary = {
+                "message": "Dry run completed; no emails sent",
+                "recipients": len(leads),
+            }
             db.update_job_status(session, job_id, "dry_run", result=summary)
-        return SendResponse(job_id=job_id, queued=False, summary=summary)
+            return SendResponse(job_id=job_id, queued=False, summary=summary)
 
-    summary = _process_sends(job_id, leads, payload.get("metrics", {}), template_name)
+        db.update_job_status(session, job_id, "queued")
+
+    # Delivery runs after the response is sent; clients poll /status/{job_id}.
+    background_tasks.add_task(
+        _run_send_job, job_id, leads, payload.get("metrics", {}), template_name
+    )
+    summary = {
+        "message": "Send queued; poll /status for results",
+        "recipients": len(leads),
+    }
     return SendResponse(job_id=job_id, queued=True, summary=summary)
 
 
+def _run_send_job(
+    job_id: str,
+    leads: List[Dict[str, Any]],
+    metrics: Dict[str, Any],
+    template_name: str,
+) -> None:
+    try:
+        _process_sends(job_id, leads, metrics, template_name)
+    except Exception as exc:
+        logger.exception("Send job %s failed", job_id)
+        with db.get_session() as session:
+            db.update_job_status(session, job_id, "failed", result={"error": str(exc)})
+
+
 def _process_sends(
     job_id: str,
     leads: List[Dict[str, Any]],
     metrics: Dict[str, Any],
     template_name: str,
 ) -> Dict[str, Any]:
-    sent = 0
     skipped = 0
     suppressed = 0
-    failures: List[str] = []
+    recipients: List[Dict[str, Any]] = []
 
+    # Keep DB transactions short: nothing below holds a session open across SendGrid I/O.
     with db.get_session() as session:
-        for lead in leads:
-            email = lead.get("email")
-            if not email:
-                skipped += 1
-                continue
-            if db.is_suppressed(session, email):
-                suppressed += 1
-                continue
-            context = {**metrics, **lead}
-            html = render_email(template_name, context)
-            payload = EmailPayload(
-                to_email=email,
+        suppressed_set = db.load_suppressions(
+            session, [lead["email"] for lead in leads if lead.get("email")]
+        )
+    for lead in leads:
+        email = lead.get("email")
+        if not email:
+            skipped += 1
+        elif email.lower() in suppressed_set:
+            suppressed += 1
+        else:
+            recipients.append(lead)
+
+    def render_and_send(lead: Dict[str, Any]) -> SendResult:
+        # Rendering inside the worker overlaps Jinja work with other leads' SendGrid I/O.
+        return _send_one(
+            EmailPayload(
+                to_email=lead["email"],
                 subject="Funding options tailored for your business",
-                html_content=html,
+                html_content=render_email(template_name, ChainMap(lead, metrics)),
             )
-            success = send_email_with_fallback(payload)
-            if success:
+        )
+
+    # Failed sends are retried in later rounds, after the whole batch has had its first
+    # attempt, so a flaky recipient never holds up the rest of the job.
+    # Only temporary failures are retried; rejected sends fail on the first attempt.
+    sent = 0
+    failures: List[str] = []
+    pending = recipients
+    for attempt in range(SEND_MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(_retry_delay(attempt))
+        pending = interleave_by_domain(pending, lambda lead: lead["email"])
+        results = _run_bounded(render_and_send, pending)
+        retry: List[Dict[str, Any]] = []
+        for lead, result in zip(pending, results):
+            if result.sent:
                 sent += 1
+            elif result.retryable:
+                retry.append(lead)
             else:
-                failures.append(email)
+                failures.append(lead["email"])
+        pending = retry
+        if not pending:
+            break
+    failures.extend(lead["email"] for lead in pending)
 
     summary = {
         "sent": sent,
@@ -254,7 +446,6 @@ def _process_sends(
         "suppressed": suppressed,
         "failures": failures,
     }
-
     with db.get_session() as session:
         status = "completed" if not failures else "completed_with_errors"
         db.update_job_status(session, job_id, status, result=summary)
@@ -262,26 +453,58 @@ def _process_sends(
     return summary
 
 
+def _retry_delay(attempt: int) -> float:
+    """Exponential backoff with jitter: about 2s, 4s, ... capped at 300s."""
+    return min(2**attempt, 300) * (0.5 + random.random())
+
+
+def _send_one(payload: EmailPayload) -> SendResult:
+    try:
+        return send_email_with_fallback(payload)
+    except Exception:
+        logger.exception("send failed for recipient %s", payload.to_email)
+        return SendResult(False, "send failed")
+
+
+def _run_bounded(func: Callable[[T], R], items: List[T]) -> List[R]:
+    # SendGrid calls are network-bound; the MPS_LIMIT limiter on
+    # send_email_with_fallback still caps the overall send rate.
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(len(items), MPS_LIMIT)) as executor:
+        return list(executor.map(func, items))
+
+
+def _send_direct_payloads(payloads: List[EmailPayload]) -> List[SendResult]:
+    # Every direct_send recipient gets the same subject and body, so more than one
+    # recipient goes out as a single multi-personalization request.
+    if len(payloads) <= 1:
+        return [_send_one(payload) for payload in payloads]
+    try:
+        return send_email_bulk(payloads)
+    except Exception:
+        logger.exception("bulk send failed for %d recipients", len(payloads))
+        return [SendResult(False, "send failed")] * len(payloads)
+
+
 def _normalize_recipients(raw: Union[EmailStr, List[EmailStr]]) -> List[str]:
     if isinstance(raw, list):
         candidates = [str(email) for email in raw]
     else:
         candidates = [str(raw)]
 
-    unique: List[str] = []
-    seen = set()
+    # Dedupe case-insensitively, keeping the first spelling of each address in order.
+    unique: Dict[str, str] = {}
     for email in candidates:
-        lowered = email.lower()
-        if lowered not in seen:
-            seen.add(lowered)
-            unique.append(email)
-    return unique
+        unique.setdefault(email.lower(), email)
+    return list(unique.values())
+
+
+_direct_send_bucket = TokenBucket(rate=MPS_LIMIT / WINDOW_SECONDS, capacity=MPS_LIMIT)
 
 
 @app.post("/direct_send", response_model=DirectSendResponse)
-@sleep_and_retry
-@limits(calls=MPS_LIMIT, period=WINDOW_SECONDS)
-def direct_send_endpoint(
+async def direct_send_endpoint(
     # Preferred path: JSON body
     payload: Optional[DirectSendRequest] = Body(None),
     # Legacy path: ?payload=<JSON>
@@ -318,46 +541,61 @@ def direct_send_endpoint(
     recipients = _normalize_recipients(payload.to_email)
     if not recipients:
         raise HTTPException(status_code=422, detail="At least one recipient email is required.")
+    # Larger lists would sleep on the send rate limit while the caller waits.
+    if len(recipients) > MAX_BULK_RECIPIENTS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"direct_send accepts at most {MAX_BULK_RECIPIENTS} recipients; use /prepare and /send for larger lists.",
+        )
+    if DOMAIN_MPS_LIMIT and max(Counter(map(email_domain, recipients)).values()) > DOMAIN_MPS_LIMIT:
+        raise HTTPException(
+            status_code=422,
+            detail=f"direct_send accepts at most {DOMAIN_MPS_LIMIT} recipients per domain; use /prepare and /send.",
+        )
 
-    results: List[DirectSendRecipientResult] = []
-    any_success = False
-    any_failure = False
+    # Over the limit, wait on the event loop instead of sleeping a worker thread.
+    await asyncio.sleep(_direct_send_bucket.reserve())
+    return await run_in_threadpool(_direct_send, message_id, payload, recipients)
 
-    for email in recipients:
-        with db.get_session() as session:
-            if db.is_suppressed(session, email):
-                results.append(DirectSendRecipientResult(email=email, sent=False, reason="suppressed"))
-                any_failure = True
-                continue
-
-        email_payload = EmailPayload(
-            to_email=email,
-            subject=payload.subject,
-            html_content=payload.body_html,  # footer should already be present per agent
-        )
 
-        if payload.dry_run:
-            results.append(DirectSendRecipientResult(email=email, sent=True))
-            any_success = True
+def _direct_send(
+    message_id: str, payload: DirectSendRequest, recipients: List[str]
+) -> DirectSendResponse:
+    outcomes: Dict[str, DirectSendRecipientResult] = {}
+    email_payloads: List[EmailPayload] = []
+
+    with db.get_session() as session:
+        suppressed = db.load_suppressions(session, recipients)
+
+    for email in recipients:
+        if email.lower() in suppressed:
+            outcomes[email] = DirectSendRecipientResult(email=email, sent=False, reason="suppressed")
             continue
 
-        try:
-            sent_ok, send_error = send_email_with_fallback(email_payload)
-        except Exception:
-            logger.exception("direct_send send failed for recipient %s", email)
-            results.append(DirectSendRecipientResult(email=email, sent=False, reason="send failed"))
-            any_failure = True
+        if payload.dry_run:
+            outcomes[email] = DirectSendRecipientResult(email=email, sent=True)
             continue
 
-        if not sent_ok:
-            results.append(
-                DirectSendRecipientResult(email=email, sent=False, reason=send_error or "send failed")
+        email_payloads.append(
+            EmailPayload(
+                to_email=email,
+                subject=payload.subject,
+                html_content=payload.body_html,  # footer should already be present per agent
             )
-            any_failure = True
-        else:
-            results.append(DirectSendRecipientResult(email=email, sent=True))
-            any_success = True
+        )
+
+    # Never retried here: the caller is waiting, so temporary failures are flagged
+    # retryable and resending is left to the client.
+    for email_payload, result in zip(email_payloads, _send_direct_payloads(email_payloads)):
+        email = email_payload.to_email
+        outcomes[email] = DirectSendRecipientResult(
+            email=email,
+            sent=result.sent,
+            reason=None if result.sent else result.error or "send failed",
+            retryable=result.retryable,
+        )
 
+    results = [outcomes[email] for email in recipients]
     if not results:
         return DirectSendResponse(sent=False, id=message_id, reason="no recipients provided", results=results)
 
@@ -375,18 +613,29 @@ def direct_send_endpoint(
     )
 
 
-@app.get("/status/{job_id}", response_model=StatusResponse)
-def status_endpoint(job_id: str, _: None = Depends(auth)) -> StatusResponse:
+# Returns pre-serialized JSON: the stored payload/result bytes are embedded as-is,
+# skipping both orjson.loads and FastAPI's response-model validation.
+@app.get(
+    "/status/{job_id}",
+    response_model=None,
+    responses={200: {"model": StatusResponse}},
+)
+def status_endpoint(
+    job_id: str,
+    include_payload: bool = Query(False, description="Also return the stored job payload"),
+    _: None = Depends(auth),
+) -> Response:
     with db.get_session() as session:
-        job = db.get_job(session, job_id)
+        job = db.get_job(session, job_id, with_payload=include_payload)
         if job is None:
             raise HTTPException(status_code=404, detail="Job not found")
-        return StatusResponse(
-            job_id=job.id,
-            status=job.status,
-            payload=job.get_payload(),
-            result=job.get_result(),
-        )
+        _expire_stale_prepare(session, job)
+        return _json_response({
+            "job_id": job.id,
+            "status": job.status,
+            "payload": job.get_payload_fragment() if include_payload else None,
+            "result": job.get_result_fragment(),
+        })
 
 
 @app.get("/unsubscribe", response_model=SuppressionResponse)
@@ -405,8 +654,15 @@ def unsubscribe_post(
     return SuppressionResponse(email=str(req.email), suppressed=added)
 
 
+_TEMPLATES = {
+    "conservative": "conservative.html.j2",
+    "assertive": "assertive.html.j2",
+}
+
+
 def _resolve_template(tone: str) -> str:
-    if tone not in {"conservative", "assertive"}:
+    template_name = _TEMPLATES.get(tone)
+    if template_name is None:
         logger.warning("Unknown tone '%s', defaulting to conservative", tone)
-        tone = DEFAULT_TONE
-    return f"{tone}.html.j2"
+        template_name = _TEMPLATES[DEFAULT_TONE]
+    return template_name
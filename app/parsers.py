@@ -2,31 +2,41 @@
 
 from __future__ import annotations
 
-import json
 import logging
 import os
 import re
+import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Union
 
 import pandas as pd
 from pdf2image import convert_from_path  # type: ignore
 from pdfminer.high_level import extract_text
 from pytesseract import image_to_string
 
-FINANCIAL_PATTERNS = {
-    "avg_deposits": re.compile(r"avg(?:erage)?\s+deposits?\s*[:$]?\s*([\d,.,]+)", re.I),
-    "nsf_count": re.compile(r"nsf\s*(?:count)?\s*[:]?\s*(\d+)", re.I),
-    "monthly_revenue": re.compile(r"monthly\s+revenue\s*[:$]?\s*([\d,.,]+)", re.I),
-}
-
-PII_PATTERNS = [
-    re.compile(r"\b\d{3}-\d{2}-\d{4}\b"),  # SSN
-    re.compile(r"\b\d{4}\s\d{4}\s\d{4}\s\d{4}\b"),  # Credit card
-    re.compile(r"\b\d{16}\b"),
-]
+# One alternation per concern so each text is scanned once; the named group that
+# matched (``match.lastgroup``) identifies the metric.
+FINANCIAL_PATTERN = re.compile(
+    r"avg(?:erage)?\s+deposits?\s*[:$]?\s*(?P<avg_deposits>[\d,.,]+)"
+    r"|nsf\s*(?:count)?\s*[:]?\s*(?P<nsf_count>\d+)"
+    r"|monthly\s+revenue\s*[:$]?\s*(?P<monthly_revenue>[\d,.,]+)",
+    re.I,
+)
+FINANCIAL_KEYS = frozenset(FINANCIAL_PATTERN.groupindex)
+
+PII_PATTERN = re.compile(
+    r"\b(?:"
+    r"\d{3}-\d{2}-\d{4}"  # SSN
+    r"|\d{4}\s\d{4}\s\d{4}\s\d{4}"  # Credit card
+    r"|\d{16}"
+    r")\b"
+)
+
+CSV_CHUNK_ROWS = 5000
+UPLOAD_COPY_CHUNK = 1024 * 1024
 
 logger = logging.getLogger(__name__)
 
@@ -47,24 +57,26 @@ def _normalize_currency(value: str) -> Optional[float]:
 
 def _extract_metrics(text: str) -> Dict[str, Any]:
     metrics: Dict[str, Any] = {}
-    for key, pattern in FINANCIAL_PATTERNS.items():
-        match = pattern.search(text)
-        if not match:
+    seen = set()
+    for match in FINANCIAL_PATTERN.finditer(text):
+        key = match.lastgroup
+        if key in seen:
             continue
+        # Like a per-pattern search(), only the first occurrence of each metric counts.
+        seen.add(key)
         if "count" in key:
-            metrics[key] = int(match.group(1))
+            metrics[key] = int(match.group(key))
         else:
-            value = _normalize_currency(match.group(1))
+            value = _normalize_currency(match.group(key))
             if value is not None:
                 metrics[key] = value
+        if len(seen) == len(FINANCIAL_KEYS):
+            break
     return metrics
 
 
 def _redact_pii(text: str) -> str:
-    redacted = text
-    for pattern in PII_PATTERNS:
-        redacted = pattern.sub("[REDACTED]", redacted)
-    return redacted
+    return PII_PATTERN.sub("[REDACTED]", text)
 
 
 def _parse_pdf_text(pdf_path: Path) -> str:
@@ -83,12 +95,20 @@ def _parse_pdf_text(pdf_path: Path) -> str:
         logger.warning("Unable to render PDF %s for OCR: %s", pdf_path, exc)
         return text
 
-    ocr_chunks: List[str] = []
-    for index, image in enumerate(images):
+    def ocr_page(index: int, image: Any) -> str:
         try:
-            ocr_chunks.append(image_to_string(image))
+            return image_to_string(image)
         except Exception as exc:  # pragma: no cover - pytesseract runtime errors
             logger.warning("Failed OCR on page %s of %s: %s", index + 1, pdf_path, exc)
+            return ""
+
+    # pytesseract shells out to the tesseract binary per page, so threads run the
+    # pages in parallel processes without pickling the rendered images.
+    if len(images) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1)) as executor:
+            ocr_chunks = list(executor.map(ocr_page, range(len(images)), images))
+    else:
+        ocr_chunks = [ocr_page(index, image) for index, image in enumerate(images)]
     ocr_text = "\n".join(chunk for chunk in ocr_chunks if chunk.strip())
     return ocr_text or text
 
@@ -100,21 +120,42 @@ def parse_pdf(pdf_path: Path) -> Dict[str, Any]:
     return {"metrics": metrics, "raw_text": sanitized_text[:2000]}
 
 
-def parse_csv(csv_path: Path) -> List[Dict[str, Any]]:
-    df = pd.read_csv(csv_path)
+def _coalesce(df: pd.DataFrame, *columns: str) -> Optional[pd.Series]:
+    merged: Optional[pd.Series] = None
+    for column in columns:
+        if column in df.columns:
+            merged = df[column] if merged is None else merged.fillna(df[column])
+    return merged
+
+
+def _normalize_leads(df: pd.DataFrame) -> List[Dict[str, Any]]:
     df.columns = [col.strip().lower() for col in df.columns]
-    leads: List[Dict[str, Any]] = []
-    for _, row in df.iterrows():
-        lead = {
-            "company": row.get("company") or row.get("business") or "Unknown",
-            "contact_name": row.get("contact") or row.get("name"),
-            "email": str(row.get("email", "")).strip(),
-            "phone": str(row.get("phone", "")).strip(),
-            "avg_deposits": row.get("avg_deposits"),
-            "nsf_count": row.get("nsf") or row.get("nsf_count"),
-        }
-        leads.append({k: v for k, v in lead.items() if pd.notna(v) and v != "nan"})
-    return leads
+    columns: Dict[str, Any] = {}
+    company = _coalesce(df, "company", "business")
+    columns["company"] = "Unknown" if company is None else company.fillna("Unknown")
+    contact = _coalesce(df, "contact", "name")
+    if contact is not None:
+        columns["contact_name"] = contact
+    for key in ("email", "phone"):
+        columns[key] = df[key].astype(str).str.strip() if key in df.columns else ""
+    if "avg_deposits" in df.columns:
+        columns["avg_deposits"] = df["avg_deposits"]
+    nsf = _coalesce(df, "nsf", "nsf_count")
+    if nsf is not None:
+        columns["nsf_count"] = nsf
+    records = pd.DataFrame(columns, index=df.index).to_dict("records")
+    return [{k: v for k, v in lead.items() if pd.notna(v) and v != "nan"} for lead in records]
+
+
+def iter_csv_leads(source: Union[Path, BinaryIO]) -> Iterator[Dict[str, Any]]:
+    """Yield normalized leads, reading the CSV ``CSV_CHUNK_ROWS`` rows at a time."""
+    with pd.read_csv(source, chunksize=CSV_CHUNK_ROWS) as reader:
+        for df in reader:
+            yield from _normalize_leads(df)
+
+
+def parse_csv(csv_path: Path) -> List[Dict[str, Any]]:
+    return list(iter_csv_leads(csv_path))
 
 
 def handle_uploads(files: Iterable[Any]) -> ParsedDocument:
@@ -123,36 +164,80 @@ def handle_uploads(files: Iterable[Any]) -> ParsedDocument:
 
     for upload in files:
         suffix = Path(upload.filename).suffix.lower()
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(upload.file.read())
-            tmp_path = Path(tmp.name)
-        try:
-            if suffix in {".csv"}:
-                leads.extend(parse_csv(tmp_path))
-            elif suffix in {".pdf"}:
-                parsed = parse_pdf(tmp_path)
-                metrics.update(parsed.get("metrics", {}))
-            else:
-                raise ValueError(f"Unsupported file type: {suffix}")
-        finally:
+        if suffix in {".csv"}:
+            # pandas reads the spooled upload directly; only PDFs need a real path.
+            leads.extend(iter_csv_leads(upload.file))
+        elif suffix in {".pdf"}:
+            tmp_path = _spool_upload(upload.file, suffix)
             try:
-                os.remove(tmp_path)
-            except OSError:
-                pass
+                metrics.update(parse_pdf(tmp_path).get("metrics", {}))
+            finally:
+                remove_saved_uploads([tmp_path])
+        else:
+            raise ValueError(f"Unsupported file type: {suffix}")
 
     return ParsedDocument(metrics=metrics, leads=leads)
 
 
+def save_uploads(files: Iterable[Any]) -> List[Path]:
+    """Copy uploads to temp files so they can be parsed after the request closes them."""
+    paths: List[Path] = []
+    try:
+        for upload in files:
+            suffix = Path(upload.filename).suffix.lower()
+            if suffix not in {".csv", ".pdf"}:
+                raise ValueError(f"Unsupported file type: {suffix}")
+            paths.append(_spool_upload(upload.file, suffix))
+    except Exception:
+        remove_saved_uploads(paths)
+        raise
+    return paths
+
+
+def handle_saved_uploads(paths: Iterable[Path]) -> ParsedDocument:
+    metrics: Dict[str, Any] = {}
+    leads: List[Dict[str, Any]] = []
+
+    for path in paths:
+        if path.suffix == ".csv":
+            leads.extend(iter_csv_leads(path))
+        else:
+            metrics.update(parse_pdf(path).get("metrics", {}))
+
+    return ParsedDocument(metrics=metrics, leads=leads)
+
+
+def remove_saved_uploads(paths: Iterable[Path]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _spool_upload(source: BinaryIO, suffix: str) -> Path:
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        shutil.copyfileobj(source, tmp, length=UPLOAD_COPY_CHUNK)
+        return Path(tmp.name)
+
+
 def redact_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
-    redacted = json.loads(json.dumps(payload))
-    for lead in redacted.get("leads", []):
-        if "email" in lead:
-            lead["email"] = _mask_email(lead["email"])
-        if "phone" in lead:
-            lead["phone"] = _mask_phone(lead["phone"])
+    # Only the lead dicts are modified, so copy just those; everything else is shared.
+    redacted = dict(payload)
+    if "leads" in redacted:
+        redacted["leads"] = [redact_lead(lead) for lead in redacted["leads"]]
     return redacted
 
 
+def redact_lead(lead: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(lead)
+    if "email" in out:
+        out["email"] = _mask_email(out["email"])
+    if "phone" in out:
+        out["phone"] = _mask_phone(out["phone"])
+    return out
+
+
 def _mask_email(email: str) -> str:
     if "@" not in email:
         return email
@@ -4,22 +4,31 @@ from __future__ import annotations
 
 import logging
 import os
-from dataclasses import dataclass
-from pathlib import Path
-from typing import Any, Dict, Optional
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Mapping, NamedTuple, Optional, Tuple, TypeVar
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-from ratelimit import limits, sleep_and_retry
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Email, Mail, ReplyTo, To
-from tenacity import RetryError, retry, stop_after_attempt, wait_exponential
+import httpx
+import orjson
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template, select_autoescape
 
 logger = logging.getLogger(__name__)
 
-TEMPLATES_DIR = Path(__file__).resolve().parent / "templates"
+T = TypeVar("T")
+
+# abspath, not Path.resolve(): no per-component lstat/realpath work at import.
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
 MPS_LIMIT = int(os.getenv("MPS_LIMIT", "60"))
+# Optional extra cap per recipient domain, on top of the account-wide MPS_LIMIT.
+DOMAIN_MPS_LIMIT = int(os.getenv("DOMAIN_MPS_LIMIT") or 0) or None
 WINDOW_SECONDS = int(os.getenv("WINDOW_SECONDS", "60"))
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
+SENDGRID_API_URL = "https://api.sendgrid.com"
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+# A bulk batch never asks the send bucket for more than it holds, so the wait before
+# any one batch stays within a single window.
+MAX_BULK_RECIPIENTS = min(SENDGRID_MAX_PERSONALIZATIONS, MPS_LIMIT)
 FROM_EMAIL = os.getenv("FROM_EMAIL", "funding@rhfunding.io")
 FROM_NAME = os.getenv("FROM_NAME", "RedHat Funding")
 REPLY_TO_EMAIL = os.getenv("REPLY_TO_EMAIL", FROM_EMAIL)
@@ -29,40 +38,96 @@ BUSINESS_ADDRESS = os.getenv(
 )
 OPTOUT_MODE = os.getenv("OPTOUT_MODE", "link")
 OPTOUT_LINK = os.getenv("OPTOUT_LINK", "https://rhfunding.io/unsubscribe")
+# Unset uses Jinja's per-user cache directory under the system temp dir.
+JINJA_BCC_DIR = os.getenv("JINJA_BCC_DIR") or None
+
+_TEMPLATE_DEFAULTS: Dict[str, Any] = {
+    "business_name": BUSINESS_NAME,
+    "business_address": BUSINESS_ADDRESS,
+    "from_name": FROM_NAME,
+    "optout_mode": OPTOUT_MODE,
+}
+# The default opt-out link is fixed at startup, so its query separator is too.
+_OPTOUT_PREFIX = f"{OPTOUT_LINK}{'&' if '?' in OPTOUT_LINK else '?'}email="
 
 _env: Optional[Environment] = None
+# Resolved templates by name; skips Environment.get_template's loader/cache-key path.
+_template_cache: Dict[str, Template] = {}
+_sendgrid_http: Optional[httpx.Client] = None
+_sendgrid_http_lock = threading.Lock()
 
 
 def get_template_env() -> Environment:
     global _env
     if _env is None:
         _env = Environment(
-            loader=FileSystemLoader(str(TEMPLATES_DIR)),
+            loader=FileSystemLoader(TEMPLATES_DIR),
             autoescape=select_autoescape(["html", "xml"]),
+            # Templates ship with the image: compile once, never stat for changes.
+            auto_reload=False,
+            cache_size=-1,
+            # Persist compiled bytecode so restarted workers skip parsing and codegen.
+            bytecode_cache=FileSystemBytecodeCache(directory=JINJA_BCC_DIR),
         )
+        # Compile every shipped template up front so no request pays for parsing.
+        for name in _env.list_templates(extensions=["j2"]):
+            _template_cache[name] = _env.get_template(name)
     return _env
 
 
-def render_email(template_name: str, context: Dict[str, Any]) -> str:
-    env = get_template_env()
-    template = env.get_template(template_name)
+def render_email(template_name: str, context: Mapping[str, Any]) -> str:
+    template = _template_cache.get(template_name)
+    if template is None:
+        template = _template_cache[template_name] = get_template_env().get_template(template_name)
 
-    context_with_defaults = dict(context)
-    context_with_defaults.setdefault("business_name", BUSINESS_NAME)
-    context_with_defaults.setdefault("business_address", BUSINESS_ADDRESS)
-    context_with_defaults.setdefault("from_name", FROM_NAME)
-    context_with_defaults.setdefault("optout_mode", OPTOUT_MODE)
-
-    base_unsubscribe_url = context_with_defaults.get("unsubscribe_url", OPTOUT_LINK)
     email = context.get("email", "")
-    if email:
+    base_unsubscribe_url = context.get("unsubscribe_url")
+    if base_unsubscribe_url is None:
+        unsubscribe_url = _OPTOUT_PREFIX + email if email else OPTOUT_LINK
+    elif email:
         separator = "&" if "?" in base_unsubscribe_url else "?"
         unsubscribe_url = f"{base_unsubscribe_url}{separator}email={email}"
     else:
         unsubscribe_url = base_unsubscribe_url
-    context_with_defaults["unsubscribe_url"] = unsubscribe_url
 
-    return template.render(**context_with_defaults)
+    # One merged dict; render() would flatten a ChainMap into a dict anyway, and
+    # passing it positionally avoids the extra **kwargs copy.
+    return template.render({**_TEMPLATE_DEFAULTS, **context, "unsubscribe_url": unsubscribe_url})
+
+
+@dataclass
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at ``rate`` tokens per second."""
+
+    rate: float
+    capacity: float
+    tokens: float = field(init=False)
+    last_refill: float = field(init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+
+    def reserve(self, cost: float = 1) -> float:
+        """Claim ``cost`` tokens and return the seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= cost
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self) -> bool:
+        """Whether the bucket has refilled to capacity, i.e. has been idle for a full window."""
+        with self._lock:
+            return self.tokens + (time.monotonic() - self.last_refill) * self.rate >= self.capacity
+
+    def acquire(self, cost: float = 1) -> None:
+        """Block the calling thread until ``cost`` tokens are available."""
+        wait = self.reserve(cost)
+        if wait > 0:
+            time.sleep(wait)
 
 
 @dataclass
@@ -72,53 +137,225 @@ class EmailPayload:
     html_content: str
 
 
-def _build_mail(payload: EmailPayload) -> Mail:
-    message = Mail(
-        from_email=Email(FROM_EMAIL, FROM_NAME),
-        subject=payload.subject,
-        html_content=payload.html_content,
-    )
-    message.add_to(To(email=payload.to_email))
-    if REPLY_TO_EMAIL:
-        message.reply_to = ReplyTo(email=REPLY_TO_EMAIL, name=FROM_NAME)
+class SendResult(NamedTuple):
+    sent: bool
+    error: Optional[str] = None
+    # Set for failures worth another attempt later (network errors, 429, 5xx).
+    retryable: bool = False
+
+
+# Mail send request bodies are built as plain dicts in the v3 /mail/send shape; the
+# sender fields are fixed at startup and shared by every message.
+_FROM: Dict[str, str] = {"email": FROM_EMAIL, "name": FROM_NAME}
+_REPLY_TO: Optional[Dict[str, str]] = (
+    {"email": REPLY_TO_EMAIL, "name": FROM_NAME} if REPLY_TO_EMAIL else None
+)
+
+
+def _mail_body(
+    personalizations: List[Dict[str, Any]], subject: str, html_content: str
+) -> Dict[str, Any]:
+    message: Dict[str, Any] = {
+        "personalizations": personalizations,
+        "from": _FROM,
+        "subject": subject,
+        "content": [{"type": "text/html", "value": html_content}],
+    }
+    if _REPLY_TO is not None:
+        message["reply_to"] = _REPLY_TO
     return message
 
 
-def _dispatch_sendgrid(message: Mail) -> int:
-    if not SENDGRID_API_KEY:
-        raise RuntimeError("SENDGRID_API_KEY is not configured")
-    client = SendGridAPIClient(SENDGRID_API_KEY)
-    response = client.send(message)
+def _build_mail(payload: EmailPayload) -> Dict[str, Any]:
+    return _mail_body(
+        [{"to": [{"email": payload.to_email}]}], payload.subject, payload.html_content
+    )
+
+
+def _get_sendgrid_http() -> httpx.Client:
+    # One shared client keeps connections (and their TLS sessions) alive across sends.
+    # The first batch starts many send workers at once, so creation is locked.
+    global _sendgrid_http
+    client = _sendgrid_http
+    if client is None:
+        with _sendgrid_http_lock:
+            client = _sendgrid_http
+            if client is None:
+                if not SENDGRID_API_KEY:
+                    raise RuntimeError("SENDGRID_API_KEY is not configured")
+                client = _sendgrid_http = httpx.Client(
+                    base_url=SENDGRID_API_URL,
+                    headers={
+                        "Authorization": f"Bearer {SENDGRID_API_KEY}",
+                        "Accept": "application/json",
+                        "Content-Type": "application/json",
+                    },
+                    timeout=30.0,
+                    # Up to MPS_LIMIT send workers run at once; keep one warm connection
+                    # each instead of httpx's default 20 keep-alive slots.
+                    limits=httpx.Limits(
+                        max_connections=MPS_LIMIT, max_keepalive_connections=MPS_LIMIT
+                    ),
+                )
+    return client
+
+
+def close_sendgrid_http() -> None:
+    global _sendgrid_http
+    with _sendgrid_http_lock:
+        client, _sendgrid_http = _sendgrid_http, None
+    if client is not None:
+        client.close()
+
+
+def _dispatch_sendgrid(message: Dict[str, Any]) -> int:
+    # orjson emits the (often large, HTML-heavy) body as bytes in one C pass.
+    response = _get_sendgrid_http().post("/v3/mail/send", content=orjson.dumps(message))
     logger.info(
         "SendGrid response status=%s body=%s",
         response.status_code,
-        response.body.decode("utf-8") if hasattr(response.body, "decode") else response.body,
+        response.text,
     )
     return response.status_code
 
 
-@retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(3))
-def send_email(payload: EmailPayload) -> None:
-    message = _build_mail(payload)
-    status = _dispatch_sendgrid(message)
-    if status >= 400:
-        raise RuntimeError(f"SendGrid returned status {status}")
+def _build_bulk_mail(subject: str, html_content: str, to_emails: List[str]) -> Dict[str, Any]:
+    # One personalization per recipient, so no one sees the other addresses.
+    return _mail_body([{"to": [{"email": email}]} for email in to_emails], subject, html_content)
+
 
+# Network-level failures (connect, read, timeouts) are worth another attempt later.
+_RETRYABLE = (httpx.TransportError,)
 
-@sleep_and_retry
-@limits(calls=MPS_LIMIT, period=WINDOW_SECONDS)
-def send_email_with_fallback(payload: EmailPayload) -> tuple[bool, Optional[str]]:
+
+def _deliver(message: Dict[str, Any]) -> SendResult:
+    # Single attempt: retries are scheduled by the batch job, never slept through inline.
+    # Expected failures get a one-line log; tracebacks are kept for the unknown ones.
     try:
-        send_email(payload)
-        return True, None
-    except RetryError as exc:  # pragma: no cover - informational logging
-        last_exc = exc.last_attempt.exception() if getattr(exc, "last_attempt", None) else exc
-        logger.error(
-            "Failed to send email after retries. Last error: %s",
-            last_exc,
-            exc_info=last_exc,
-        )
-        return False, str(last_exc)
-    except Exception as exc:  # pragma: no cover - unexpected
-        logger.exception("Unexpected error while sending email: %s", exc)
-        return False, str(exc)
+        status = _dispatch_sendgrid(message)
+    except _RETRYABLE as exc:
+        logger.warning("Retryable send failure: %r", exc)
+        return SendResult(False, str(exc), retryable=True)
+    except Exception as exc:
+        logger.exception("Error while sending email: %s", exc)
+        return SendResult(False, str(exc))
+
+    if status < 400:
+        return SendResult(True)
+    error = f"SendGrid returned status {status}"
+    if status == 429 or status >= 500:
+        logger.warning("Retryable send failure: %s", error)
+        return SendResult(False, error, retryable=True)
+    logger.error("SendGrid rejected email: %s", error)
+    return SendResult(False, error)
+
+
+# Refills continuously, so sends stay smooth instead of bunching at window edges.
+_send_bucket = TokenBucket(rate=MPS_LIMIT / WINDOW_SECONDS, capacity=MPS_LIMIT)
+
+
+_domain_buckets: Dict[str, TokenBucket] = {}
+_domain_buckets_lock = threading.Lock()
+_domain_buckets_swept = time.monotonic()
+
+
+def _acquire_send_tokens(to_emails: List[str]) -> None:
+    # Domain tokens are claimed before the shared budget, so a throttled domain never
+    # holds shared tokens while it waits. Callers interleave recipients by domain so a
+    # worker waiting here is not blocking leads for other domains.
+    if DOMAIN_MPS_LIMIT:
+        per_domain: Dict[str, int] = {}
+        for email in to_emails:
+            domain = email_domain(email)
+            per_domain[domain] = per_domain.get(domain, 0) + 1
+        wait = max(_reserve_domain_tokens(domain, count) for domain, count in per_domain.items())
+        if wait > 0:
+            time.sleep(wait)
+    _send_bucket.acquire(len(to_emails))
+
+
+def _reserve_domain_tokens(domain: str, count: int) -> float:
+    global _domain_buckets_swept
+    with _domain_buckets_lock:
+        # A full bucket behaves exactly like a fresh one, so idle domains are dropped to
+        # keep the map from growing with every domain ever sent to. Buckets only fill
+        # after a window of inactivity, so sweeping more often would find nothing.
+        now = time.monotonic()
+        if now - _domain_buckets_swept >= WINDOW_SECONDS:
+            _domain_buckets_swept = now
+            for idle in [name for name, bucket in _domain_buckets.items() if bucket.is_full()]:
+                del _domain_buckets[idle]
+        bucket = _domain_buckets.get(domain)
+        if bucket is None:
+            bucket = _domain_buckets[domain] = TokenBucket(
+                rate=DOMAIN_MPS_LIMIT / WINDOW_SECONDS, capacity=DOMAIN_MPS_LIMIT
+            )
+        # Reserving under the map lock means a bucket is never swept between lookup and use.
+        return bucket.reserve(count)
+
+
+def email_domain(email: str) -> str:
+    return email.rpartition("@")[2].lower()
+
+
+def interleave_by_domain(items: List[T], email_of: Callable[[T], str]) -> List[T]:
+    """Reorder ``items`` round-robin across recipient domains, keeping order within each.
+
+    With DOMAIN_MPS_LIMIT set, a run of leads for one domain would otherwise park every
+    worker on that domain's bucket while leads for other domains wait behind them.
+    """
+    by_domain: Dict[str, List[T]] = {}
+    for item in items:
+        by_domain.setdefault(email_domain(email_of(item)), []).append(item)
+    interleaved: List[T] = []
+    queues = list(by_domain.values())
+    for position in range(max((len(queue) for queue in queues), default=0)):
+        interleaved.extend(queue[position] for queue in queues if position < len(queue))
+    return interleaved
+
+
+def send_email_with_fallback(payload: EmailPayload) -> SendResult:
+    _acquire_send_tokens([payload.to_email])
+    return _deliver(_build_mail(payload))
+
+
+def _bulk_batches(indexes: List[int], payloads: List[EmailPayload]) -> Iterator[List[int]]:
+    # Like the account-wide cap, no batch asks a domain bucket for more than it holds;
+    # a larger reservation would leave the bucket in debt and stall that domain's
+    # /send workers for minutes.
+    if DOMAIN_MPS_LIMIT:
+        indexes = interleave_by_domain(indexes, lambda index: payloads[index].to_email)
+    batch: List[int] = []
+    per_domain: Dict[str, int] = {}
+    for index in indexes:
+        domain = email_domain(payloads[index].to_email)
+        if len(batch) == MAX_BULK_RECIPIENTS or per_domain.get(domain, 0) == DOMAIN_MPS_LIMIT:
+            yield batch
+            batch, per_domain = [], {}
+        batch.append(index)
+        per_domain[domain] = per_domain.get(domain, 0) + 1
+    if batch:
+        yield batch
+
+
+def send_email_bulk(payloads: List[EmailPayload]) -> List[SendResult]:
+    """Send payloads that share a subject and body as one request per batch of recipients.
+
+    Returns one ``SendResult`` per payload, in input order. SendGrid accepts or
+    rejects a request as a whole, so every recipient in a batch shares its outcome.
+    """
+    groups: Dict[Tuple[str, str], List[int]] = {}
+    for index, payload in enumerate(payloads):
+        groups.setdefault((payload.subject, payload.html_content), []).append(index)
+
+    results: List[SendResult] = [SendResult(False)] * len(payloads)
+    for (subject, html_content), indexes in groups.items():
+        for batch in _bulk_batches(indexes, payloads):
+            to_emails = [payloads[i].to_email for i in batch]
+            # MPS_LIMIT counts emails, not API requests.
+            _acquire_send_tokens(to_emails)
+            message = _build_bulk_mail(subject, html_content, to_emails)
+            outcome = _deliver(message)
+            for index in batch:
+                results[index] = outcome
+    return results
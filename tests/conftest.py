@@ -0,0 +1,28 @@
+import os
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+TEST_DB_PATH = Path("tmp/test_emailer.db")
+TEST_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+
+# Set before any test module imports app.db, which reads these at import time.
+os.environ.setdefault("DB_PATH", f"sqlite:///{TEST_DB_PATH}")
+os.environ.setdefault("API_BEARER_TOKEN", "dev")
+
+from app import db  # noqa: E402
+from app.main import app  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def reset_db() -> None:
+    db.Base.metadata.drop_all(bind=db.engine)
+    db.Base.metadata.create_all(bind=db.engine)
+    yield
+
+
+@pytest.fixture()
+def client() -> TestClient:
+    # Authenticated by default; endpoint tests only care about the dev token.
+    return TestClient(app, headers={"Authorization": "Bearer dev"})
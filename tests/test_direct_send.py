@@ -1,38 +1,14 @@
 import json
-import os
-from pathlib import Path
 
 import pytest
 from fastapi.testclient import TestClient
 
-TEST_DB_PATH = Path("tmp/test_emailer.db")
-TEST_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-
-os.environ.setdefault("DB_PATH", f"sqlite:///{TEST_DB_PATH}")
-os.environ.setdefault("API_BEARER_TOKEN", "dev")
-
-from app import db  # noqa: E402
-from app.main import app  # noqa: E402
-
-
-def auth() -> dict[str, str]:
-    return {"Authorization": "Bearer dev"}
-
-
-@pytest.fixture(autouse=True)
-def reset_db() -> None:
-    db.Base.metadata.drop_all(bind=db.engine)
-    db.Base.metadata.create_all(bind=db.engine)
-    yield
-
-
-@pytest.fixture()
-def client() -> TestClient:
-    return TestClient(app)
+from app import db
+from app.utils import SendResult
 
 
 def test_health_includes_version(client: TestClient) -> None:
-    res = client.get("/health", headers=auth())
+    res = client.get("/health")
     assert res.status_code == 200
     body = res.json()
     assert body["status"] == "ok"
@@ -44,7 +20,7 @@ def test_direct_send_json_dry_run_ok(monkeypatch: pytest.MonkeyPatch, client: Te
 
     def fake_send(_payload):
         called["value"] = True
-        return True, None
+        return SendResult(True)
 
     monkeypatch.setattr("app.main.send_email_with_fallback", fake_send)
 
@@ -54,7 +30,7 @@ def test_direct_send_json_dry_run_ok(monkeypatch: pytest.MonkeyPatch, client: Te
         "body_html": "<p>hi</p>",
         "dry_run": True,
     }
-    res = client.post("/direct_send", headers=auth(), json=payload)
+    res = client.post("/direct_send", json=payload)
     assert res.status_code == 200
     body = res.json()
     assert body["sent"] is True
@@ -67,7 +43,7 @@ def test_direct_send_json_dry_run_ok(monkeypatch: pytest.MonkeyPatch, client: Te
 
 def test_direct_send_legacy_payload_ok(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
     def fake_send(_payload):
-        return True, None
+        return SendResult(True)
 
     monkeypatch.setattr("app.main.send_email_with_fallback", fake_send)
 
@@ -78,7 +54,7 @@ def test_direct_send_legacy_payload_ok(monkeypatch: pytest.MonkeyPatch, client:
         "dry_run": True,
     }
     q = json.dumps(legacy)
-    res = client.post(f"/direct_send?payload={q}", headers=auth())
+    res = client.post(f"/direct_send?payload={q}")
     assert res.status_code == 200
     body = res.json()
     assert body["sent"] is True
@@ -95,7 +71,7 @@ def test_direct_send_suppressed(client: TestClient) -> None:
         "body_html": "<p>hi</p>",
         "dry_run": False,
     }
-    res = client.post("/direct_send", headers=auth(), json=payload)
+    res = client.post("/direct_send", json=payload)
     assert res.status_code == 200
     body = res.json()
     assert body["sent"] is False
@@ -111,20 +87,20 @@ def test_direct_send_empty_body_html_rejected(client: TestClient) -> None:
         "body_html": "   ",
         "dry_run": True,
     }
-    res = client.post("/direct_send", headers=auth(), json=payload)
+    res = client.post("/direct_send", json=payload)
     assert res.status_code == 422
     assert "body_html" in res.json()["detail"]
 
 
 def test_direct_send_invalid_legacy_json(client: TestClient) -> None:
-    res = client.post("/direct_send?payload={not-json}", headers=auth())
+    res = client.post("/direct_send?payload={not-json}")
     assert res.status_code == 422
     assert "Invalid JSON" in res.json()["detail"]
 
 
 def test_direct_send_real_send_failure(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
     def fake_send(_payload):
-        return False, "send failed"
+        return SendResult(False, "send failed")
 
     monkeypatch.setattr("app.main.send_email_with_fallback", fake_send)
 
@@ -134,7 +110,7 @@ def test_direct_send_real_send_failure(monkeypatch: pytest.MonkeyPatch, client:
         "body_html": "<p>hi</p>",
         "dry_run": False,
     }
-    res = client.post("/direct_send", headers=auth(), json=payload)
+    res = client.post("/direct_send", json=payload)
     assert res.status_code == 200
     body = res.json()
     assert body["sent"] is False
@@ -142,14 +118,41 @@ def test_direct_send_real_send_failure(monkeypatch: pytest.MonkeyPatch, client:
     assert body["results"][0]["reason"] == "send failed"
 
 
-def test_direct_send_multiple_recipients(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
+def test_direct_send_flags_temporary_failure_without_retrying(
+    monkeypatch: pytest.MonkeyPatch, client: TestClient
+) -> None:
     calls = []
 
-    def fake_send(payload):
+    def flaky_send(payload):
         calls.append(payload.to_email)
-        return True, None
+        return SendResult(False, "SendGrid returned status 503", retryable=True)
 
-    monkeypatch.setattr("app.main.send_email_with_fallback", fake_send)
+    monkeypatch.setattr("app.main.send_email_with_fallback", flaky_send)
+
+    payload = {
+        "to_email": "test@example.com",
+        "subject": "Test",
+        "body_html": "<p>hi</p>",
+        "dry_run": False,
+    }
+    res = client.post("/direct_send", json=payload)
+    assert res.status_code == 200
+    body = res.json()
+    assert body["sent"] is False
+    assert body["results"] == [
+        {"email": "test@example.com", "sent": False, "reason": "SendGrid returned status 503", "retryable": True}
+    ]
+    assert calls == ["test@example.com"]
+
+
+def test_direct_send_multiple_recipients(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
+    calls = []
+
+    def fake_bulk(payloads):
+        calls.append([p.to_email for p in payloads])
+        return [SendResult(True)] * len(payloads)
+
+    monkeypatch.setattr("app.main.send_email_bulk", fake_bulk)
 
     payload = {
         "to_email": ["user1@example.com", "user2@example.com"],
@@ -157,10 +160,74 @@ def test_direct_send_multiple_recipients(monkeypatch: pytest.MonkeyPatch, client
         "body_html": "<p>hi</p>",
         "dry_run": False,
     }
-    res = client.post("/direct_send", headers=auth(), json=payload)
+    res = client.post("/direct_send", json=payload)
     assert res.status_code == 200
     body = res.json()
     assert body["sent"] is True
     assert len(body["results"]) == 2
     assert {result["email"] for result in body["results"]} == {"user1@example.com", "user2@example.com"}
-    assert len(calls) == 2
+    assert calls == [["user1@example.com", "user2@example.com"]]
+
+
+def test_direct_send_multiple_recipients_skips_suppressed(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
+    calls = []
+
+    def fake_send(payload):
+        calls.append(payload.to_email)
+        return SendResult(True)
+
+    monkeypatch.setattr("app.main.send_email_with_fallback", fake_send)
+    with db.get_session() as session:
+        db.add_to_suppression(session, "user2@example.com")
+
+    payload = {
+        "to_email": ["user1@example.com", "User2@example.com"],
+        "subject": "Test",
+        "body_html": "<p>hi</p>",
+        "dry_run": False,
+    }
+    res = client.post("/direct_send", json=payload)
+    assert res.status_code == 200
+    body = res.json()
+    assert body["sent"] is False
+    assert body["reason"] == "suppressed"
+    assert [(r["email"], r["sent"]) for r in body["results"]] == [
+        ("user1@example.com", True),
+        ("User2@example.com", False),
+    ]
+    assert calls == ["user1@example.com"]
+
+
+def test_direct_send_rejects_more_recipients_than_one_rate_window(
+    monkeypatch: pytest.MonkeyPatch, client: TestClient
+) -> None:
+    monkeypatch.setattr("app.main.MAX_BULK_RECIPIENTS", 2)
+    sends = []
+    monkeypatch.setattr("app.main.send_email_bulk", lambda payloads: sends.append(payloads))
+
+    payload = {
+        "to_email": ["a@example.com", "b@example.com", "c@example.com"],
+        "subject": "Test",
+        "body_html": "<p>hi</p>",
+        "dry_run": False,
+    }
+    res = client.post("/direct_send", json=payload)
+    assert res.status_code == 422
+    assert "at most 2 recipients" in res.json()["detail"]
+    assert sends == []
+
+
+def test_direct_send_rejects_more_recipients_per_domain_than_its_limit(
+    monkeypatch: pytest.MonkeyPatch, client: TestClient
+) -> None:
+    monkeypatch.setattr("app.main.DOMAIN_MPS_LIMIT", 1)
+
+    payload = {
+        "to_email": ["a@example.com", "b@other.com", "c@Example.com"],
+        "subject": "Test",
+        "body_html": "<p>hi</p>",
+        "dry_run": True,
+    }
+    res = client.post("/direct_send", json=payload)
+    assert res.status_code == 422
+    assert "at most 1 recipients per domain" in res.json()["detail"]
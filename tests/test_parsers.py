@@ -0,0 +1,41 @@
+from pathlib import Path
+
+from app.parsers import parse_csv
+
+MESSY_CSV = """\
+ Company ,Business,Contact,Name, Email ,Phone,avg_deposits,NSF,nsf_count
+Acme Bakery,,Jordan Smith,,  jordan@acmebakery.com ,555-0100,45000,0,
+,Northside Fitness,,Kim Lee,kim@nsidefit.com,,52000,,4
+,,,,alex@summitplumb.com,555-0120,,,
+"""
+
+
+def test_parse_csv_normalizes_messy_columns(tmp_path: Path) -> None:
+    csv_path = tmp_path / "leads.csv"
+    csv_path.write_text(MESSY_CSV)
+
+    leads = parse_csv(csv_path)
+
+    assert leads == [
+        {
+            "company": "Acme Bakery",
+            "contact_name": "Jordan Smith",
+            "email": "jordan@acmebakery.com",
+            "phone": "555-0100",
+            "avg_deposits": 45000,
+            "nsf_count": 0,
+        },
+        {
+            # Empty company/contact cells fall back to business/name.
+            "company": "Northside Fitness",
+            "contact_name": "Kim Lee",
+            "email": "kim@nsidefit.com",
+            "avg_deposits": 52000,
+            "nsf_count": 4,
+        },
+        {
+            "company": "Unknown",
+            "email": "alex@summitplumb.com",
+            "phone": "555-0120",
+        },
+    ]
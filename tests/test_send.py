@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from app import db
+from app.parsers import ParsedDocument
+from app.utils import SendResult
+
+SAMPLE_LEADS = Path(__file__).resolve().parent.parent / "samples" / "sample_leads.csv"
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("app.main._retry_delay", lambda _attempt: 0)
+
+
+def _prepare(client: TestClient) -> str:
+    with SAMPLE_LEADS.open("rb") as handle:
+        res = client.post(
+            "/prepare",
+            files={"files": ("leads.csv", handle, "text/csv")},
+            data={"tone": "conservative"},
+        )
+    assert res.status_code == 200
+    return res.json()["prepare_id"]
+
+
+def test_send_queues_job_and_reports_via_status(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
+    calls = []
+
+    def fake_send(payload):
+        calls.append(payload.to_email)
+        if payload.to_email == "kim@nsidefit.com":
+            return SendResult(False, "send failed")
+        return SendResult(True)
+
+    monkeypatch.setattr("app.main.send_email_with_fallback", fake_send)
+    prepare_id = _prepare(client)
+    with db.get_session() as session:
+        db.add_to_suppression(session, "alex@summitplumb.com")
+
+    res = client.post("/send", json={"prepare_id": prepare_id, "dry_run": False})
+    assert res.status_code == 200
+    body = res.json()
+    assert body["queued"] is True
+    assert body["summary"]["recipients"] == 3
+
+    status = client.get(f"/status/{body['job_id']}").json()
+    assert status["status"] == "completed_with_errors"
+    assert status["result"] == {
+        "sent": 1,
+        "skipped_missing_contact": 0,
+        "suppressed": 1,
+        "failures": ["kim@nsidefit.com"],
+    }
+    assert sorted(calls) == ["jordan@acmebakery.com", "kim@nsidefit.com"]
+
+
+def test_send_retries_failed_recipients(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
+    attempts: dict[str, int] = {}
+
+    def flaky_send(payload):
+        attempts[payload.to_email] = attempts.get(payload.to_email, 0) + 1
+        if payload.to_email == "kim@nsidefit.com" and attempts[payload.to_email] == 1:
+            return SendResult(False, "SendGrid returned status 503", retryable=True)
+        return SendResult(True)
+
+    monkeypatch.setattr("app.main.send_email_with_fallback", flaky_send)
+    prepare_id = _prepare(client)
+
+    res = client.post("/send", json={"prepare_id": prepare_id, "dry_run": False})
+    status = client.get(f"/status/{res.json()['job_id']}").json()
+    assert status["status"] == "completed"
+    assert status["result"]["sent"] == 3
+    assert status["result"]["failures"] == []
+    assert attempts == {"jordan@acmebakery.com": 1, "kim@nsidefit.com": 2, "alex@summitplumb.com": 1}
+
+
+def test_send_dry_run_does_not_send(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
+    def fake_send(_payload):
+        raise AssertionError("dry run must not send")
+
+    monkeypatch.setattr("app.main.send_email_with_fallback", fake_send)
+    prepare_id = _prepare(client)
+
+    res = client.post("/send", json={"prepare_id": prepare_id, "dry_run": True})
+    assert res.status_code == 200
+    body = res.json()
+    assert body["queued"] is False
+    status = client.get(f"/status/{body['job_id']}").json()
+    assert status["status"] == "dry_run"
+
+
+def test_background_prepare_reports_via_status(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
+    monkeypatch.setattr("app.main.send_email_with_fallback", lambda _payload: SendResult(True))
+    with SAMPLE_LEADS.open("rb") as handle:
+        res = client.post(
+            "/prepare",
+            files={"files": ("leads.csv", handle, "text/csv")},
+            data={"tone": "conservative", "background": "true"},
+        )
+    assert res.status_code == 200
+    body = res.json()
+    assert body["status"] == "processing"
+    assert body["preview"] == []
+
+    status = client.get(f"/status/{body['prepare_id']}").json()
+    assert status["status"] == "prepared"
+    assert status["result"]["count"] == 3
+    assert len(status["result"]["preview"]) == 3
+
+    res = client.post("/send", json={"prepare_id": body["prepare_id"], "dry_run": True})
+    assert res.status_code == 200
+    assert res.json()["summary"]["recipients"] == 3
+
+
+def test_prepare_serializes_numpy_values(monkeypatch: pytest.MonkeyPatch, client: TestClient) -> None:
+    parsed = ParsedDocument(
+        metrics={"avg_deposits": np.float64(45000.0)},
+        leads=[{"company": "Acme Bakery", "email": "jordan@acmebakery.com", "nsf_count": np.int64(2)}],
+    )
+    monkeypatch.setattr("app.main.handle_uploads", lambda _files: parsed)
+
+    res = client.post(
+        "/prepare",
+        files={"files": ("leads.csv", b"ignored", "text/csv")},
+        data={"tone": "conservative"},
+    )
+    assert res.status_code == 200
+    body = res.json()
+    assert body["metrics"] == {"avg_deposits": 45000.0}
+    assert body["preview"][0]["lead"]["nsf_count"] == 2
+
+
+def test_send_rejects_prepare_still_processing(client: TestClient) -> None:
+    with db.get_session() as session:
+        job = db.create_job(session, {"tone": "conservative"})
+        db.update_job_status(session, job.id, "processing")
+        prepare_id = job.id
+
+    res = client.post("/send", json={"prepare_id": prepare_id, "dry_run": True})
+    assert res.status_code == 409
+
+
+def test_stale_processing_prepare_is_failed(client: TestClient) -> None:
+    with db.get_session() as session:
+        job = db.create_job(session, {"tone": "conservative"})
+        db.update_job_status(session, job.id, "processing")
+        job.updated_at = datetime.utcnow() - timedelta(hours=1)
+        prepare_id = job.id
+
+    status = client.get(f"/status/{prepare_id}").json()
+    assert status["status"] == "failed"
+    assert "upload the files again" in status["result"]["error"]
+
+    res = client.post("/send", json={"prepare_id": prepare_id, "dry_run": True})
+    assert res.status_code == 400
@@ -0,0 +1,34 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import db
+
+
+@pytest.fixture()
+def job_id() -> str:
+    with db.get_session() as session:
+        job = db.create_job(session, {"leads": [{"email": "lead@example.com"}]})
+        db.update_job_status(session, job.id, "completed", result={"sent": 1})
+        return job.id
+
+
+def test_status_omits_payload_by_default(client: TestClient, job_id: str) -> None:
+    res = client.get(f"/status/{job_id}")
+    assert res.status_code == 200
+    body = res.json()
+    assert body["status"] == "completed"
+    assert body["payload"] is None
+    assert body["result"] == {"sent": 1}
+
+
+def test_status_include_payload(client: TestClient, job_id: str) -> None:
+    res = client.get(f"/status/{job_id}?include_payload=true")
+    assert res.status_code == 200
+    body = res.json()
+    assert body["payload"] == {"leads": [{"email": "lead@example.com"}]}
+    assert body["result"] == {"sent": 1}
+
+
+def test_status_unknown_job(client: TestClient) -> None:
+    res = client.get("/status/missing")
+    assert res.status_code == 404
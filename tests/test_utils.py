@@ -0,0 +1,184 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+from app import utils
+
+
+@pytest.fixture()
+def sendgrid_key(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(utils, "SENDGRID_API_KEY", "test-key")
+    utils.close_sendgrid_http()
+    yield
+    utils.close_sendgrid_http()
+
+
+def test_sendgrid_client_created_once_across_threads(sendgrid_key: None) -> None:
+    with ThreadPoolExecutor(max_workers=30) as executor:
+        clients = list(executor.map(lambda _: utils._get_sendgrid_http(), range(30)))
+    assert len({id(client) for client in clients}) == 1
+
+    utils.close_sendgrid_http()
+    assert clients[0].is_closed
+    assert utils._get_sendgrid_http() is not clients[0]
+
+
+def _mock_sendgrid(monkeypatch: pytest.MonkeyPatch, handler) -> list:
+    requests = []
+
+    def record(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return handler(request)
+
+    client = httpx.Client(base_url=utils.SENDGRID_API_URL, transport=httpx.MockTransport(record))
+    monkeypatch.setattr(utils, "_sendgrid_http", client)
+    return requests
+
+
+@pytest.mark.parametrize(
+    ("status_code", "sent", "retryable"),
+    [(202, True, False), (400, False, False), (429, False, True), (503, False, True)],
+)
+def test_deliver_classifies_sendgrid_status(
+    monkeypatch: pytest.MonkeyPatch, status_code: int, sent: bool, retryable: bool
+) -> None:
+    requests = _mock_sendgrid(monkeypatch, lambda _request: httpx.Response(status_code))
+    payload = utils.EmailPayload("lead@example.com", "Hello", "<p>hi</p>")
+
+    result = utils._deliver(utils._build_mail(payload))
+
+    assert result.sent is sent
+    assert result.retryable is retryable
+    assert result.error == (None if sent else f"SendGrid returned status {status_code}")
+    assert [r.url.path for r in requests] == ["/v3/mail/send"]
+
+
+def test_deliver_treats_connection_errors_as_retryable(monkeypatch: pytest.MonkeyPatch) -> None:
+    def refuse(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("connection reset", request=request)
+
+    _mock_sendgrid(monkeypatch, refuse)
+    payload = utils.EmailPayload("lead@example.com", "Hello", "<p>hi</p>")
+
+    result = utils._deliver(utils._build_mail(payload))
+
+    assert result == utils.SendResult(False, "connection reset", retryable=True)
+
+
+def test_bulk_batches_never_exceed_send_bucket_capacity(monkeypatch: pytest.MonkeyPatch) -> None:
+    token_requests = []
+    monkeypatch.setattr(utils, "_acquire_send_tokens", lambda to_emails: token_requests.append(len(to_emails)))
+    monkeypatch.setattr(utils, "_deliver", lambda _message: utils.SendResult(True))
+    count = utils.MAX_BULK_RECIPIENTS + 1
+    payloads = [utils.EmailPayload(f"lead{i}@example.com", "Hello", "<p>hi</p>") for i in range(count)]
+
+    results = utils.send_email_bulk(payloads)
+
+    assert results == [utils.SendResult(True)] * count
+    assert token_requests == [utils.MAX_BULK_RECIPIENTS, 1]
+    assert utils.MAX_BULK_RECIPIENTS <= utils._send_bucket.capacity
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps: list = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture()
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    fake = FakeClock()
+    monkeypatch.setattr(utils, "time", fake)
+    return fake
+
+
+def test_token_bucket_bursts_to_capacity_then_refills(clock: FakeClock) -> None:
+    bucket = utils.TokenBucket(rate=2, capacity=4)
+
+    assert [bucket.reserve() for _ in range(4)] == [0.0] * 4
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert not bucket.is_full()
+
+    clock.now += 1
+    assert bucket.reserve() == 0.0
+
+    clock.now += 10
+    assert bucket.is_full()
+    assert bucket.reserve(4) == 0.0
+
+
+def test_token_bucket_acquire_sleeps_for_reserved_wait(clock: FakeClock) -> None:
+    bucket = utils.TokenBucket(rate=1, capacity=1)
+
+    bucket.acquire()
+    bucket.acquire(2)
+
+    assert clock.sleeps == [pytest.approx(2.0)]
+
+
+@pytest.fixture()
+def domain_limit(monkeypatch: pytest.MonkeyPatch, clock: FakeClock) -> None:
+    monkeypatch.setattr(utils, "DOMAIN_MPS_LIMIT", 2)
+    monkeypatch.setattr(utils, "WINDOW_SECONDS", 1)
+    monkeypatch.setattr(utils, "_send_bucket", utils.TokenBucket(rate=1000, capacity=1000))
+    monkeypatch.setattr(utils, "_domain_buckets", {})
+    monkeypatch.setattr(utils, "_domain_buckets_swept", clock.now)
+
+
+def test_domain_limit_throttles_only_the_busy_domain(clock: FakeClock, domain_limit: None) -> None:
+    utils._acquire_send_tokens(["a@gmail.com", "b@Gmail.com"])
+    utils._acquire_send_tokens(["c@gmail.com"])
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+    utils._acquire_send_tokens(["lead@other.com"])
+    assert len(clock.sleeps) == 1
+
+
+def test_idle_domain_buckets_are_dropped(clock: FakeClock, domain_limit: None) -> None:
+    utils._acquire_send_tokens(["a@gmail.com", "b@other.com"])
+    assert set(utils._domain_buckets) == {"gmail.com", "other.com"}
+
+    clock.now += 0.9
+    utils._acquire_send_tokens(["c@gmail.com", "d@gmail.com"])
+    clock.now += 0.2
+    utils._acquire_send_tokens(["e@third.com"])
+
+    assert set(utils._domain_buckets) == {"gmail.com", "third.com"}
+
+
+def test_bulk_batches_never_exceed_domain_capacity(monkeypatch: pytest.MonkeyPatch, domain_limit: None) -> None:
+    batches = []
+    monkeypatch.setattr(utils, "_acquire_send_tokens", lambda to_emails: batches.append(to_emails))
+    monkeypatch.setattr(utils, "_deliver", lambda _message: utils.SendResult(True))
+    emails = [f"lead{i}@gmail.com" for i in range(5)] + ["x@other.com"]
+
+    results = utils.send_email_bulk([utils.EmailPayload(email, "Hello", "<p>hi</p>") for email in emails])
+
+    assert results == [utils.SendResult(True)] * len(emails)
+    assert batches == [
+        ["lead0@gmail.com", "x@other.com", "lead1@gmail.com"],
+        ["lead2@gmail.com", "lead3@gmail.com"],
+        ["lead4@gmail.com"],
+    ]
+
+
+def test_interleave_by_domain_round_robins_and_keeps_order() -> None:
+    emails = [f"lead{i}@gmail.com" for i in range(4)] + ["x@other.com", "y@Other.com", "z@third.com"]
+
+    assert utils.interleave_by_domain(emails, str) == [
+        "lead0@gmail.com",
+        "x@other.com",
+        "z@third.com",
+        "lead1@gmail.com",
+        "y@Other.com",
+        "lead2@gmail.com",
+        "lead3@gmail.com",
+    ]